@@ -34,26 +34,17 @@ Restructered and modernized code: Copyright (c) 2025 Bram van Dartel <xirixiz@gm
 ***
 """
 
+import logging
+import os
 import sys
 import re
+import threading
 from pathlib import Path
 from dataclasses import dataclass
 from typing import Optional, Dict, List, Any
 from urllib.parse import urlparse
-from argparse import ArgumentParser
-from xml.dom import minidom
-from getpass import getpass
-from io import StringIO
-
-try:
-    from lxml.etree import Element, ElementTree, tostring
-    USING_LXML = True
-except ImportError:
-    try:
-        from xml.etree.ElementTree import Element, ElementTree, tostring
-        USING_LXML = False
-    except ImportError:
-        raise ImportError('Failed to find python lxml or elementtree. Please install one or use Python >= 3.6')
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape as xml_escape
 
 try:
     import cups
@@ -68,52 +59,66 @@ except ImportError:
     HAS_AVAHI = False
 
 # Constants
-XML_TEMPLATE = """<!DOCTYPE service-group SYSTEM "avahi-service.dtd">
-<service-group>
-<name replace-wildcards="yes"></name>
-<service>
-    <type>_ipps._tcp</type>
-    <subtype>_universal._sub._ipps._tcp</subtype>
-    <port>631</port>
-    <txt-record>txtvers=1</txt-record>
-    <txt-record>qtotal=1</txt-record>
-    <txt-record>Transparent=T</txt-record>
-    <txt-record>URF=DM3</txt-record>
-    <txt-record>TLS=1.2</txt-record>
-</service>
-</service-group>"""
-
-ALLOWED_DOCUMENT_TYPES = {
-    'application/pdf': True,
-    'application/postscript': True,
-    'application/vnd.cups-raster': True,
-    'application/octet-stream': True,
-    'image/urf': True,
-    'image/png': True,
-    'image/tiff': True,
-    'image/jpeg': True,
-    'image/gif': True,
-    'text/plain': True,
-    'text/html': True,
-}
-
-BLOCKED_DOCUMENT_TYPES = {
-    'image/x-xwindowdump': False,
-    'image/x-xpixmap': False,
-    'image/x-xbitmap': False,
-    'image/x-sun-raster': False,
-    'image/x-sgi-rgb': False,
-    'image/x-portable-pixmap': False,
-    'image/x-portable-graymap': False,
-    'image/x-portable-bitmap': False,
-    'image/x-portable-anymap': False,
-    'application/x-shell': False,
-    'application/x-perl': False,
-    'application/x-csource': False,
-    'application/x-cshell': False,
-}
-
-DOCUMENT_TYPES = {**ALLOWED_DOCUMENT_TYPES, **BLOCKED_DOCUMENT_TYPES}
+_SERVICE_HEADER = (
+    b'<?xml version="1.0" standalone=\'no\'?>\n'
+    b'<!DOCTYPE service-group SYSTEM "avahi-service.dtd">\n'
+    b'<service-group>\n'
+)
+_SERVICE_TYPE = (
+    b'<service>\n'
+    b'<type>_ipps._tcp</type>\n'
+    b'<subtype>_universal._sub._ipps._tcp</subtype>\n'
+)
+_SERVICE_STATIC_TXT = (
+    b'<txt-record>txtvers=1</txt-record>\n'
+    b'<txt-record>qtotal=1</txt-record>\n'
+    b'<txt-record>Transparent=T</txt-record>\n'
+    b'<txt-record>URF=DM3</txt-record>\n'
+    b'<txt-record>TLS=1.2</txt-record>\n'
+)
+_SERVICE_FOOTER = b'</service>\n</service-group>\n'
+
+ALLOWED_DOCUMENT_TYPES = frozenset({
+    'application/pdf',
+    'application/postscript',
+    'application/vnd.cups-raster',
+    'application/octet-stream',
+    'image/urf',
+    'image/png',
+    'image/tiff',
+    'image/jpeg',
+    'image/gif',
+    'text/plain',
+    'text/html',
+})
+
+BLOCKED_DOCUMENT_TYPES = frozenset({
+    'image/x-xwindowdump',
+    'image/x-xpixmap',
+    'image/x-xbitmap',
+    'image/x-sun-raster',
+    'image/x-sgi-rgb',
+    'image/x-portable-pixmap',
+    'image/x-portable-graymap',
+    'image/x-portable-bitmap',
+    'image/x-portable-anymap',
+    'application/x-shell',
+    'application/x-perl',
+    'application/x-csource',
+    'application/x-cshell',
+})
+
+DOCUMENT_TYPES = ALLOWED_DOCUMENT_TYPES | BLOCKED_DOCUMENT_TYPES
+
+# TXT keys written for CUPS printers; plain ASCII names that never need escaping
+_PLAIN_TXT_KEYS = frozenset({
+    'rp', 'note', 'product', 'ty', 'printer-state', 'printer-type', 'pdl',
+    'media-default', 'adminurl', 'air',
+    'Bind', 'Duplex', 'Collate', 'Copies', 'Color', 'Binary',
+})
+
+_URI_RE = re.compile(r'^//(.*):(\d+)(/.*)')
+_LEADING_SLASH_RE = re.compile(r'^/+')
 
 @dataclass
 class PrinterInfo:
@@ -150,78 +155,70 @@ class AirPrintGenerator:
         self.use_cups = use_cups and HAS_CUPS
         self.use_avahi = use_avahi and HAS_AVAHI
         self.dns_domain = dns_domain
+        self._cached_password: Optional[str] = None
+
+        # Pick the log sink once instead of checking verbose on every call
+        if self.verbose:
+            self._log = lambda message: print(message, file=sys.stderr)
+        else:
+            self._log = lambda message: None
 
         if self.user and HAS_CUPS:
             cups.setUser(self.user)
 
-    def _log(self, message: str) -> None:
-        """Helper method for verbose logging"""
-        if self.verbose:
-            print(message, file=sys.stderr)
-
-    def _validate_txt_record(self, key: str, value: str) -> Optional[str]:
-        """Validate and potentially truncate TXT record to stay within DNS limits"""
-        txt_record = f"{key}={value}"
-        if len(txt_record.encode('utf-8')) >= 255:
-            self._log(f"Warning: TXT record {key} exceeds 255 bytes, truncating")
-            # Try to truncate the value while keeping a valid UTF-8 string
-            max_bytes = 254 - len(key.encode('utf-8')) - 1  # -1 for '='
-            value_bytes = value.encode('utf-8')
-            truncated_bytes = value_bytes[:max_bytes]
-            while not self._is_valid_utf8(truncated_bytes):
-                truncated_bytes = truncated_bytes[:-1]
-            return truncated_bytes.decode('utf-8')
-        return value
-
-    def _is_valid_utf8(self, bytes_str: bytes) -> bool:
-        """Check if a byte string is valid UTF-8"""
-        try:
-            bytes_str.decode('utf-8')
-            return True
-        except UnicodeDecodeError:
-            return False
+    def _validate_txt_record(self, key: str, value: str) -> str:
+        """Validate and potentially truncate a TXT record value to stay within DNS limits"""
+        # ASCII strings are one byte per character, so their length needs no encoding
+        if key.isascii() and value.isascii() and len(key) + 1 + len(value) < 255:
+            return value
+
+        key_length = len(key.encode('utf-8'))
+        value_bytes = value.encode('utf-8')
+        if key_length + 1 + len(value_bytes) < 255:
+            return value
+
+        self._log(f"Warning: TXT record {key} exceeds 255 bytes, truncating")
+        # Cut at the byte limit and let the decoder drop a trailing partial character
+        max_bytes = 254 - key_length - 1  # -1 for '='
+        return value_bytes[:max_bytes].decode('utf-8', errors='ignore')
 
     def _process_printer_formats(self, attrs: Dict[str, Any]) -> str:
         """Process and validate printer format support"""
-        formats = []
-        deferred = []
-
-        for fmt in attrs['document-format-supported']:
-            if fmt in DOCUMENT_TYPES:
-                if DOCUMENT_TYPES[fmt]:
-                    formats.append(fmt)
-            else:
-                deferred.append(fmt)
+        supported = attrs['document-format-supported']
+        formats = [fmt for fmt in supported if fmt in ALLOWED_DOCUMENT_TYPES]
+        deferred = [fmt for fmt in supported if fmt not in DOCUMENT_TYPES]
 
         if 'image/urf' not in formats:
             print(f"Warning: image/urf not in mime types, printer may not be available on iOS 6+",
                   file=sys.stderr)
 
         all_formats = ','.join(formats + deferred)
-        return self._validate_txt_record('pdl', all_formats).split('=', 1)[1]
+        return self._validate_txt_record('pdl', all_formats)
 
     def _get_printer_capabilities(self, attrs: Dict[str, Any]) -> Dict[str, str]:
         """Extract printer capabilities from CUPS attributes"""
         capabilities = {}
 
-        # Standard capabilities mapping
-        caps_mapping = {
-            'printer-bindings-supported': ('Bind', lambda x: 'T' if x else None),
-            'sides-supported': ('Duplex', lambda x: 'T' if 'two-sided-long-edge' in x else None),
-            'collate-supported': ('Collate', lambda x: 'T' if x else None),
-            'copies-supported': ('Copies', lambda x: 'T' if x and x > 1 else None),
-            'color-supported': ('Color', lambda x: 'T' if x else None),
-            'printer-binary-ok-supported': ('Binary', lambda x: 'T' if x else None),
-        }
-
-        for cups_key, (airprint_key, transform) in caps_mapping.items():
-            if cups_key in attrs:
-                value = transform(attrs[cups_key])
-                if value:
-                    capabilities[airprint_key] = value
+        if attrs.get('printer-bindings-supported'):
+            capabilities['Bind'] = 'T'
+        if 'two-sided-long-edge' in attrs.get('sides-supported', ()):
+            capabilities['Duplex'] = 'T'
+        if attrs.get('collate-supported'):
+            capabilities['Collate'] = 'T'
+        copies = attrs.get('copies-supported')
+        if copies and copies > 1:
+            capabilities['Copies'] = 'T'
+        if attrs.get('color-supported'):
+            capabilities['Color'] = 'T'
+        if attrs.get('printer-binary-ok-supported'):
+            capabilities['Binary'] = 'T'
 
         return capabilities
 
+    def _connect_cups(self) -> 'cups.Connection':
+        """Open a connection to the configured CUPS server"""
+        return cups.Connection(self.host, self.port) if self.host else cups.Connection()
+
     def _collect_cups_printers(self) -> List[PrinterInfo]:
         """Collect printer information from CUPS"""
         if not self.use_cups:
@@ -229,23 +226,51 @@ class AirPrintGenerator:
 
         self._log('Collecting shared printers from CUPS')
 
-        conn = cups.Connection(self.host, self.port) if self.host else cups.Connection()
-        printers = []
+        conn = self._connect_cups()
+        shared = [(name, details) for name, details in conn.getPrinters().items()
+                  if details['printer-is-shared']]
+        if not shared:
+            return []
+
+        # Prompt once for all printers rather than once per printer
+        if self.user and self._cached_password is None:
+            from getpass import getpass
+            self._cached_password = getpass('Enter password for CUPS authentication: ')
+
+        # Fetch attributes concurrently; pycups connections are not thread-safe,
+        # so every worker thread opens its own
+        local = threading.local()
+
+        def init_worker() -> None:
+            # libcups keeps the user and password callback per thread, so the
+            # settings made on the main thread do not reach the workers
+            if self.user:
+                cups.setUser(self.user)
+            if self._cached_password is not None:
+                cups.setPasswordCB(lambda prompt: self._cached_password)
+            else:
+                from getpass import getpass
+                cups.setPasswordCB(getpass)
+
+        def fetch_attributes(name: str) -> Dict[str, Any]:
+            if not hasattr(local, 'conn'):
+                local.conn = self._connect_cups()
+            return local.conn.getPrinterAttributes(name)
 
-        for name, details in conn.getPrinters().items():
-            if not details['printer-is-shared']:
-                continue
+        with ThreadPoolExecutor(max_workers=min(8, len(shared)), initializer=init_worker) as executor:
+            all_attrs = list(executor.map(fetch_attributes, [name for name, _ in shared]))
 
-            attrs = conn.getPrinterAttributes(name)
+        printers = []
+        for (name, details), attrs in zip(shared, all_attrs):
             uri = urlparse(details['printer-uri-supported'])
 
             port_no = uri.port or self.port or cups.getPort()
             resource_path = uri.path
 
             # Clean up resource path
-            if match := re.match(r'^//(.*):(\d+)(/.*)', resource_path):
+            if match := _URI_RE.match(resource_path):
                 resource_path = match.group(3)
-            resource_path = re.sub(r'^/+', '', resource_path)
+            resource_path = _LEADING_SLASH_RE.sub('', resource_path)
 
             formats = self._process_printer_formats(attrs)
 
@@ -270,7 +295,7 @@ class AirPrintGenerator:
 
             # Add auth if using CUPS authentication
             if self.user:
-                txt_records['air'] = f"{self.user},{getpass('Enter password for CUPS authentication: ')}"
+                txt_records['air'] = f"{self.user},{self._cached_password}"
 
             # Merge capabilities
             txt_records.update(capabilities)
@@ -281,7 +306,7 @@ class AirPrintGenerator:
                 if value:  # Only add non-empty values
                     validated_value = self._validate_txt_record(key, str(value))
                     if validated_value:
-                        validated_txt[key] = validated_value.split('=', 1)[1]
+                        validated_txt[key] = validated_value
 
             printer = PrinterInfo(
                 name=name,
@@ -328,72 +353,50 @@ class AirPrintGenerator:
 
     def _create_service_file(self, printer: PrinterInfo) -> None:
         """Generate service file for a printer"""
-        tree = ElementTree()
-        tree.parse(StringIO(XML_TEMPLATE.replace('\n', '').replace('\r', '').replace('\t', '')))
-
-        root = tree.getroot()
-        name_elem = tree.find('name')
-        if name_elem is not None:
-            name_elem.text = f'Sec.AirPrint {printer.name} @ %h'
-
-        service_elem = tree.find('service')
-        if service_elem is None:
-            raise ValueError("Invalid XML template: missing service element")
-
-        port_elem = service_elem.find('port')
-        if port_elem is not None:
-            port_elem.text = str(printer.port)
+        parts = [
+            _SERVICE_HEADER,
+            f'<name replace-wildcards="yes">Sec.AirPrint {xml_escape(printer.name)} @ %h</name>\n'.encode('utf-8'),
+            _SERVICE_TYPE,
+        ]
 
         if printer.host:
             host = printer.host
             if self.dns_domain:
-                parts = host.rsplit('.', 1)
-                if len(parts) > 1:
-                    host = f"{parts[0]}.{self.dns_domain}"
-            host_elem = Element('host-name')
-            host_elem.text = host
-            service_elem.append(host_elem)
-
-        # Add txt records
-        for key, value in printer.txt.items():
-            if self.adminurl or key != 'adminurl':
-                txt_elem = Element('txt-record')
-                txt_elem.text = f"{key}={value}"
-                service_elem.append(txt_elem)
+                host_parts = host.rsplit('.', 1)
+                if len(host_parts) > 1:
+                    host = f"{host_parts[0]}.{self.dns_domain}"
+            parts.append(f'<host-name>{xml_escape(host)}</host-name>\n'.encode('utf-8'))
+
+        parts.append(f'<port>{printer.port}</port>\n'.encode('utf-8'))
+        parts.append(_SERVICE_STATIC_TXT)
+
+        # Add txt records, leaving out adminurl unless it was requested
+        excluded_key = None if self.adminurl else 'adminurl'
+        parts.extend(
+            f'<txt-record>{key if key in _PLAIN_TXT_KEYS else xml_escape(key)}={xml_escape(value)}</txt-record>\n'.encode('utf-8')
+            for key, value in printer.txt.items()
+            if key != excluded_key
+        )
 
         # Add color support if available
         if printer.txt.get('color-supported'):
-            color_elem = Element('txt-record')
-            color_elem.text = 'Color=T'
-            service_elem.append(color_elem)
+            parts.append(b'<txt-record>Color=T</txt-record>\n')
 
         # Add paper size support
         if printer.txt.get('media-default') == 'iso_a4_210x297mm':
-            paper_elem = Element('txt-record')
-            paper_elem.text = 'PaperMax=legal-A4'
-            service_elem.append(paper_elem)
+            parts.append(b'<txt-record>PaperMax=legal-A4</txt-record>\n')
+
+        parts.append(_SERVICE_FOOTER)
 
         # Generate filename
         source_prefix = f"{printer.source}-" if printer.source else ""
         filename = f"{self.prefix}{source_prefix}{printer.name}.service"
 
-        if self.directory:
-            self.directory.mkdir(parents=True, exist_ok=True)
-            filepath = self.directory / filename
-        else:
-            filepath = Path(filename)
+        filepath = os.path.join(self.directory, filename) if self.directory else filename
 
-        # Write the file - binary mode for lxml, text mode for standard library
-        with filepath.open('wb' if USING_LXML else 'w', encoding=None if USING_LXML else 'utf-8') as f:
-            if USING_LXML:
-                tree.write(f, pretty_print=True, xml_declaration=True, encoding="UTF-8")
-            else:
-                xmlstr = tostring(root, encoding='unicode')
-                doc = minidom.parseString(xmlstr)
-                dt = minidom.getDOMImplementation('').createDocumentType(
-                    'service-group', None, 'avahi-service.dtd')
-                doc.insertBefore(dt, doc.documentElement)
-                doc.writexml(f)
+        # Stream the chunks straight into the buffered file, no joined copy
+        with open(filepath, 'wb') as f:
+            f.writelines(parts)
 
         self._log(f'Created from {printer.source or "unknown"}: {filepath}')
 
@@ -405,10 +408,21 @@ class AirPrintGenerator:
             print("No printers found.", file=sys.stderr)
             return
 
-        for printer in printers:
-            self._create_service_file(printer)
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+        # Avahi applies one <name> to a whole <service-group>, and every printer needs
+        # its own instance name, so each printer gets its own service file.
+        # The file name only depends on source and name; keep the last printer
+        # per file, as the serial loop did, so no file is written by two threads
+        unique = list({(p.source, p.name): p for p in printers}.values())
+
+        with ThreadPoolExecutor(max_workers=min(8, len(unique))) as executor:
+            list(executor.map(self._create_service_file, unique))
 
 def main():
+    from argparse import ArgumentParser
+
     parser = ArgumentParser(description='Generate AirPrint service files for printers')
     parser.add_argument('-s', '--dnssd', action="store_true", dest="avahi",
                       help="Search for network printers using DNS-SD (requires avahi)")
@@ -431,6 +445,12 @@ def main():
 
     args = parser.parse_args()
 
+    # Output for the avahisearch logger
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose or args.debug else logging.INFO,
+        format="%(message)s",
+    )
+
     # Debug information
     if args.debug:
         print("Debug Information:", file=sys.stderr)
@@ -457,6 +477,7 @@ def main():
             sys.exit(1)
 
     if args.cups and HAS_CUPS:
+        from getpass import getpass
         cups.setPasswordCB(getpass)
 
     generator = AirPrintGenerator(
@@ -22,28 +22,45 @@ Restructered and modernized code: Copyright (c) 2025 Bram van Dartel <xirixiz@gm
 
 from __future__ import annotations
 
+import json
 import logging
-from dataclasses import dataclass
-from typing import Dict, List, Optional, Callable, Iterable
+import os
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass, fields
 
-try:
-    import dbus
-    from dbus.mainloop.glib import DBusGMainLoop
-    import avahi
-    from gi.repository import GLib
-    HAVE_AVAHI = True
-except Exception:
-    HAVE_AVAHI = False
+CACHE_PATH = "/var/cache/cups-airprint/printers.json"
+DEFAULT_CACHE_TTL_SEC = 120.0
 
+# dbus, avahi and GLib are imported on first use by _load_backend(), so code
+# that only needs PrinterService does not pull in D-Bus and GObject
+dbus = DBusGMainLoop = avahi = GLib = None
+HAVE_AVAHI: bool | None = None
 
-@dataclass
+
+def _load_backend() -> bool:
+    global HAVE_AVAHI, dbus, DBusGMainLoop, avahi, GLib
+    if HAVE_AVAHI is None:
+        try:
+            import dbus
+            from dbus.mainloop.glib import DBusGMainLoop
+            import avahi
+            from gi.repository import GLib
+            HAVE_AVAHI = True
+        except Exception:
+            HAVE_AVAHI = False
+    return HAVE_AVAHI
+
+
+@dataclass(slots=True, frozen=True)
 class PrinterService:
     name: str
     host: str
     address: str
     port: int
     domain: str
-    txt: Dict[str, str]
+    txt: dict[str, str]
     stype: str
 
 
@@ -52,9 +69,12 @@ class AvahiPrinterFinder:
     Discovers printers using Avahi DNS SD via dbus.
 
     It browses both ipp and ipps because some devices only advertise secure IPP.
+    With airprint_only it browses the AirPrint "_universal" subtype of each, so
+    avahi never reports plain IPP devices that AirPrint clients cannot use.
     """
 
     SERVICE_TYPES = ("_ipp._tcp", "_ipps._tcp")
+    AIRPRINT_SUBTYPE = "_universal._sub."
     DEFAULT_TIMEOUT_SEC = 2.0
 
     def __init__(
@@ -63,126 +83,293 @@ class AvahiPrinterFinder:
         search_domain: str = "local",
         verbose: bool = False,
         timeout: float = DEFAULT_TIMEOUT_SEC,
+        cache_path: str | None = CACHE_PATH,
+        airprint_only: bool = True,
+        include_txt: bool = True,
     ):
-        if not HAVE_AVAHI:
+        if not _load_backend():
             raise ImportError("Missing python3 dbus, python3 gi, python3 avahi, or avahi daemon")
 
         self.search_protocol = avahi.PROTO_INET if ipv4_only else avahi.PROTO_UNSPEC
         self.search_domain = search_domain
         self.timeout = float(timeout)
+        self.cache_path = cache_path
+        self.airprint_only = airprint_only
+        self.include_txt = include_txt
 
         self.logger = logging.getLogger("avahisearch")
-        logging.basicConfig(
-            level=logging.DEBUG if verbose else logging.INFO,
-            format="%(message)s",
-        )
+        # Only raise verbosity; otherwise the level stays whatever the caller configured
+        if verbose:
+            self.logger.setLevel(logging.DEBUG)
+
+        self._running = False
+        self._deadline_source: int | None = None
+        self._server: dbus.Interface | None = None
+        self._resolve: Callable | None = None
+        self._no_flags = dbus.UInt32(0)
+        # Without TXT records avahi can skip that query for every printer
+        self._resolve_flags = dbus.UInt32(0 if include_txt else avahi.LOOKUP_NO_TXT)
+        self._pending_resolves = 0
+        self._generation = 0
+        self._browsing: set = set()
+        self._browser_types: dict[str, str] = {}
+        self._results: dict[tuple, PrinterService] = {}
+        self._arrived: deque = deque()
+        self._seen: set = set()
+        self._expires: dict[tuple, float] = {}
 
-        self._main_loop: Optional[GLib.MainLoop] = None
-        self._server: Optional[dbus.Interface] = None
-        self._receiving_events = False
-        self._results: List[PrinterService] = []
+    @staticmethod
+    def _txt_to_dict(txt_records) -> dict[str, str]:
+        # Entries arrive as dbus.ByteArray (a bytes subclass) because ResolveService
+        # is called with byte_arrays=True; partition() yields (key, b"", b"") without a value
+        items = (entry.partition(b"=") for entry in txt_records)
+        return {k.decode("utf-8", "replace"): v.decode("utf-8", "replace") for k, _, v in items}
 
     @staticmethod
-    def _txt_to_dict(txt_records) -> Dict[str, str]:
+    def _cache_ttl(txt: dict[str, str]) -> float:
         try:
-            arr = avahi.txt_array_to_string_array(txt_records)
-        except Exception:
-            arr = []
-
-        out: Dict[str, str] = {}
-        for item in arr:
-            if not isinstance(item, str):
-                item = str(item)
-            if "=" in item:
-                k, v = item.split("=", 1)
-            else:
-                k, v = item, ""
-            out[k] = v
-        return out
-
-    def _on_item_new(self, stype: str) -> Callable:
-        def handler(interface, protocol, name, _stype, domain, _flags):
-            self._receiving_events = True
-            try:
-                resolved = self._server.ResolveService(
-                    interface,
-                    protocol,
-                    name,
-                    stype,
-                    domain,
-                    self.search_protocol,
-                    dbus.UInt32(0),
-                )
+            return float(txt.get("TTL", DEFAULT_CACHE_TTL_SEC))
+        except ValueError:
+            return DEFAULT_CACHE_TTL_SEC
+
+    def _cache_params(self) -> list:
+        # A list, because that is what a JSON round trip turns it into
+        return [int(self.search_protocol), self.search_domain, self.airprint_only]
+
+    def _load_cache(self) -> tuple:
+        """
+        Return the unexpired cached printers by key, and whether every
+        cached entry was still fresh.
+        """
+        if not self.cache_path:
+            return {}, False
+
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                data = json.load(f)
+            # A cache written by a search with other browse settings holds a
+            # different set of printers
+            if data["params"] != self._cache_params():
+                self.logger.debug("Ignoring printer cache %s from other search settings", self.cache_path)
+                return {}, False
+            entries = data["printers"]
+            now = time.time()
+            fresh = {}
+            for entry in entries:
+                if entry["expires_at"] > now:
+                    printer = PrinterService(**entry["printer"])
+                    key = (printer.name, printer.domain)
+                    fresh[key] = printer
+                    self._expires[key] = entry["expires_at"]
+        except FileNotFoundError:
+            return {}, False
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.debug("Ignoring unreadable printer cache %s: %s", self.cache_path, e)
+            self._expires.clear()
+            return {}, False
+
+        return fresh, len(fresh) == len(entries)
+
+    def _save_cache(self) -> None:
+        # Printers resolved without TXT records would poison later full searches
+        if not self.cache_path or not self.include_txt:
+            return
+
+        # Fields may be dbus.String/dbus.UInt16, which json writes as plain str/int;
+        # asdict() would deep-copy them first. Printers without an expiry had
+        # malformed TXT records and are resolved again next time
+        entries = [
+            {
+                "expires_at": self._expires[key],
+                "printer": {field.name: getattr(printer, field.name) for field in fields(printer)},
+            }
+            for key, printer in self._results.items()
+            if key in self._expires
+        ]
+        tmp_path = f"{self.cache_path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"params": self._cache_params(), "printers": entries}, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            self.logger.debug("Could not write printer cache %s: %s", self.cache_path, e)
+
+    def _on_item_new(self, interface, protocol, name, _stype, domain, _flags, path=None) -> None:
+        stype = self._browser_types.get(path)
+        if stype is None:
+            return
+        # ipp and ipps announcements, and repeats from other interfaces,
+        # of one printer only need one resolve, even while it is in flight
+        key = (name, domain)
+        if key in self._seen:
+            return
+        self._seen.add(key)
+        self._pending_resolves += 1
+        # Replies to a search the caller abandoned must not count against the next one
+        generation = self._generation
+        self._resolve(
+            interface,
+            protocol,
+            name,
+            stype,
+            domain,
+            self.search_protocol,
+            self._resolve_flags,
+            byte_arrays=True,
+            reply_handler=lambda *resolved: self._on_resolved(generation, name, resolved),
+            error_handler=lambda e: self._on_resolve_error(generation, key, e),
+        )
 
-                _, _, r_name, r_stype, r_domain, r_host, _, r_address, r_port, r_txt, _ = resolved
-
-                self._results.append(
-                    PrinterService(
-                        name=str(r_name),
-                        host=str(r_host),
-                        address=str(r_address),
-                        port=int(r_port),
-                        domain=str(r_domain),
-                        txt=self._txt_to_dict(r_txt),
-                        stype=str(r_stype),
-                    )
+    def _on_resolved(self, generation: int, name: str, resolved: tuple) -> None:
+        if generation != self._generation:
+            return
+        self._pending_resolves -= 1
+        try:
+            _, _, r_name, r_stype, r_domain, r_host, _, r_address, r_port, r_txt, _ = resolved
+
+            key = (r_name, r_domain)
+            if key not in self._results:
+                txt = {}
+                cacheable = True
+                if self.include_txt:
+                    # One guard for the whole payload; _txt_to_dict itself cannot fail per entry
+                    try:
+                        txt = self._txt_to_dict(r_txt)
+                    except (AttributeError, TypeError) as e:
+                        self.logger.warning("Ignoring malformed TXT records for %s: %s", name, e)
+                        cacheable = False
+                self._results[key] = PrinterService(
+                    name=r_name,
+                    host=r_host,
+                    address=r_address,
+                    port=r_port,
+                    domain=r_domain,
+                    txt=txt,
+                    stype=r_stype,
                 )
-            except dbus.DBusException as e:
-                self.logger.debug(f"Resolve failed for {name}: {e}")
-            except Exception as e:
-                self.logger.debug(f"Unexpected resolve error for {name}: {e}")
-
-        return handler
-
-    def _on_all_for_now(self):
-        if self._main_loop:
-            self._main_loop.quit()
-
-    def _timeout_tick(self) -> bool:
-        if not self._receiving_events:
-            if self._main_loop:
-                self._main_loop.quit()
-            return False
-        self._receiving_events = False
-        return True
-
-    def search(self) -> List[PrinterService]:
+                if cacheable:
+                    self._expires[key] = time.time() + self._cache_ttl(txt)
+                self._arrived.append(self._results[key])
+        except Exception as e:
+            self.logger.debug("Unexpected resolve error for %s: %s", name, e)
+        self._finish_if_done()
+
+    def _on_resolve_error(self, generation: int, key: tuple, error: Exception) -> None:
+        if generation != self._generation:
+            return
+        self._pending_resolves -= 1
+        # Let a later announcement of the same printer try again
+        self._seen.discard(key)
+        self.logger.debug("Resolve failed for %s: %s", key[0], error)
+        self._finish_if_done()
+
+    def _on_all_for_now(self, path=None) -> None:
+        self._browsing.discard(self._browser_types.get(path))
+        self._finish_if_done()
+
+    def _finish_if_done(self) -> None:
+        # Done once every browser reported AllForNow and all resolves have landed
+        if not self._browsing and not self._pending_resolves:
+            self._stop()
+
+    def _on_deadline(self) -> bool:
+        self._deadline_source = None
+        self._stop()
+        return False
+
+    def _stop(self) -> None:
+        self._running = False
+        # Finished early: drop the deadline so it cannot fire into a later search
+        if self._deadline_source is not None:
+            GLib.source_remove(self._deadline_source)
+            self._deadline_source = None
+
+    def search(self) -> list[PrinterService]:
+        return list(self.iter_search())
+
+    def iter_search(self) -> Iterator[PrinterService]:
+        """Yield printers as soon as they are resolved instead of after the search ends"""
         if not HAVE_AVAHI:
-            return []
+            return
+
+        # Start from scratch so a reused finder does not carry printers,
+        # browsers or in-flight resolves over from an earlier search
+        self._generation += 1
+        self._pending_resolves = 0
+        self._browsing.clear()
+        self._browser_types.clear()
+        self._results.clear()
+        self._arrived.clear()
+        self._seen.clear()
+        self._expires.clear()
+
+        # Fresh cache entries are not resolved again; when none has expired
+        # there is nothing to browse for at all
+        cached, all_fresh = self._load_cache()
+        if cached and all_fresh:
+            self.logger.debug("Using %d cached printers from %s", len(cached), self.cache_path)
+            yield from cached.values()
+            return
+        self._results.update(cached)
+        self._seen.update(cached)
+        yield from cached.values()
 
         DBusGMainLoop(set_as_default=True)
         bus = dbus.SystemBus()
 
+        # Skip proxy introspection: every argument we send is already typed to
+        # match Avahi's signatures, so it would only add a blocking round trip
         self._server = dbus.Interface(
-            bus.get_object(avahi.DBUS_NAME, "/"),
+            bus.get_object(avahi.DBUS_NAME, "/", introspect=False),
             "org.freedesktop.Avahi.Server",
         )
-
-        browsers = []
-        for stype in self.SERVICE_TYPES:
-            path = self._server.ServiceBrowserNew(
-                avahi.IF_UNSPEC,
-                self.search_protocol,
-                stype,
-                self.search_domain,
-                dbus.UInt32(0),
-            )
-            browser = dbus.Interface(
-                bus.get_object(avahi.DBUS_NAME, path),
+        # Bound once; looking the method up on the proxy per ItemNew rebuilds it each time
+        self._resolve = self._server.get_dbus_method("ResolveService")
+
+        # Subscribe before any browser exists: a signal avahi emits before its
+        # match rule is registered never reaches us, and cached services are
+        # announced right after ServiceBrowserNew returns
+        receivers = [
+            bus.add_signal_receiver(
+                handler,
+                signal,
                 avahi.DBUS_INTERFACE_SERVICE_BROWSER,
+                avahi.DBUS_NAME,
+                path_keyword="path",
             )
-            browser.connect_to_signal("ItemNew", self._on_item_new(stype))
-            browser.connect_to_signal("AllForNow", lambda: self._on_all_for_now())
-            browsers.append(browser)
+            for signal, handler in (("ItemNew", self._on_item_new), ("AllForNow", self._on_all_for_now))
+        ]
 
-        GLib.timeout_add(int(self.timeout * 1000), self._timeout_tick)
-
-        self._main_loop = GLib.MainLoop()
-        self._main_loop.run()
-
-        dedup = {}
-        for p in self._results:
-            key = (p.name, p.host, p.port, p.stype)
-            dedup[key] = p
-
-        return list(dedup.values())
+        try:
+            for stype in self.SERVICE_TYPES:
+                path = self._server.ServiceBrowserNew(
+                    avahi.IF_UNSPEC,
+                    self.search_protocol,
+                    f"{self.AIRPRINT_SUBTYPE}{stype}" if self.airprint_only else stype,
+                    self.search_domain,
+                    self._no_flags,
+                )
+                self._browser_types[path] = stype
+                self._browsing.add(stype)
+
+            # Hard upper bound in case AllForNow or a resolve reply never arrives
+            self._deadline_source = GLib.timeout_add(int(self.timeout * 1000), self._on_deadline)
+
+            # Drive the GLib context ourselves rather than MainLoop.run(), so each
+            # printer can be handed to the caller as soon as its resolve lands
+            context = GLib.MainContext.default()
+            self._running = True
+            while self._running:
+                context.iteration(True)
+                while self._arrived:
+                    yield self._arrived.popleft()
+        finally:
+            # Also reached when the caller stops iterating early (break or
+            # close()); neither the deadline nor the signal receivers may
+            # outlive the search
+            self._stop()
+            for receiver in receivers:
+                receiver.remove()
+
+        self._save_cache()